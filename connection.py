@@ -1,78 +1,130 @@
 #!/usr/bin/python3
 
+import threading
 import time
-from datetime import datetime,timedelta
+from collections import OrderedDict
+from datetime import timedelta
 from Cassiopeia.errors import InvalidRates,InvalidServerRegion
+from Cassiopeia.requests.adapters import HTTPAdapter
 from Cassiopeia.requests.sessions import Session
 
+#orjson decodes Riot's nested payloads severalfold faster than the stdlib
+#decoder, but it stays optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 class APIRateMeter:
     '''An instance of this class can be used to track requests to the LoL API by
     specific API keys in order to limit the rate at which requests are made to
     the API according to Riot's rules on rate limiting.'''
 
+    __slots__ = ('key','_state','_wait')
+
     default_rate = ( (10,timedelta(seconds=10)), (500,timedelta(minutes=10)) )
 
     _tracked_keys = {}
     # _tracked_keys has the format:
     # _tracked_keys
     #       apikey
-    #           rates - api access rates to obey
-    #           maxdelta - longest rate to check, used for cleaning
-    #           requestTimestamps - list of timestamps when this key was used
+    #           buckets - one token bucket per rate, each a list of
+    #               [capacity, tokens refilled per nanosecond, tokens,
+    #               last refill in integer nanoseconds]
+    #           lock - serializes bucket reads and writes across threads
+    #           next_ok - earliest monotonic_ns at which the limit can clear;
+    #               0 when not known to be over limit
+
+    #Guards registration of new keys in _tracked_keys
+    _registry_lock = threading.Lock()
 
     def __init__(self,apikey,rates=None):
-        #If not tracked, set up tracking
-        if apikey not in APIRateMeter._tracked_keys.keys():
-            #Make sure they are valid rates, or raise an error
-            if not rates:
-                rates = APIRateMeter.default_rate
-            self._validaterates(rates)
-            APIRateMeter._tracked_keys[apikey] = {'rates':rates,
-                                                'maxdelta':max(rate[1] for rate in rates),
-                                                'requestTimestamps':[]}
-        else:
-            #If already tracked and new rates provided, update the rates
-            if rates:
+        with APIRateMeter._registry_lock:
+            #If not tracked, set up tracking
+            if apikey not in APIRateMeter._tracked_keys:
+                #Make sure they are valid rates, or raise an error
+                if not rates:
+                    rates = APIRateMeter.default_rate
                 self._validaterates(rates)
-                APIRateMeter._tracked_keys[apikey] = {'rates':rates,
-                                                'maxdelta':max(rate[1] for rate in rates),
-                                                'requestTimestamps':APIRateMeter._tracked_keys[apikey]['requestTimestamps']}
+                APIRateMeter._tracked_keys[apikey] = {'buckets':self._makebuckets(rates),
+                                                    'lock':threading.Lock(),
+                                                    'next_ok':0}
+            else:
+                #If already tracked and new rates provided, update the rates.
+                #Update in place so every instance bound to this key sees the
+                #new buckets.
+                if rates:
+                    self._validaterates(rates)
+                    APIRateMeter._tracked_keys[apikey]['buckets'] = self._makebuckets(rates)
+                    APIRateMeter._tracked_keys[apikey]['next_ok'] = 0
 
-        #Finally, set up the instance to know which key it tracks
+        #Finally, set up the instance to know which key it tracks and bind
+        #its shared state so the hot paths skip the class dict lookups
         self.key = apikey
+        self._state = APIRateMeter._tracked_keys[apikey]
+        self._wait = 0.0
 
     def check(self):
         '''Returns true if no rate has been exceeded. Does not count as an API
-        access itself.'''
-        rates = APIRateMeter._tracked_keys[self.key]['rates']
-        timestamps = APIRateMeter._tracked_keys[self.key]['requestTimestamps']
-        for rate in rates:
-            callcount = len([stamp for stamp in timestamps if stamp - datetime.now() < rate[1]])
-            if  callcount >= rate[0]:
-                return False
-        return True
-
-    def access(self,blocking=True,clean=True):
+        access itself. Also records how long the most constraining rate needs
+        to refill a token, so a blocked caller can sleep exactly that long.
+        While a previous check has established that the limit cannot clear
+        before a known time, returns False immediately without taking the
+        lock or touching the buckets.'''
+        if time.monotonic_ns() < self._state['next_ok']:
+            return False
+        with self._state['lock']:
+            return self._check()
+
+    def _check(self):
+        '''check without the locking; the caller must hold the key's lock.'''
+        now = time.monotonic_ns()
+        ok = True
+        wait = 0.0
+        for bucket in self._state['buckets']:
+            bucket[2] = min(bucket[0],bucket[2] + (now - bucket[3])*bucket[1])
+            bucket[3] = now
+            if bucket[2] < 1:
+                ok = False
+                wait = max(wait,(1 - bucket[2])/bucket[1])
+        self._state['next_ok'] = now + int(wait) if not ok else 0
+        self._wait = wait*1e-9
+        return ok
+
+    def access(self,blocking=True):
         '''Call to log an access to the API. If blocking is True, the method
         will block if the rate limit has been exceeded until it believes that
-        enough time has passed that the API should no longer be blocked.
-        If clean is True, this method also calls APIRateMeter.cleantimestamps.'''
-        if blocking:
-            while not self.check():
-                time.sleep(0.01)
-        if clean:
-            self.cleantimestamps()
-        APIRateMeter._tracked_keys[self.key]['requestTimestamps'].append(datetime.now())
-
-    def cleantimestamps(self):
-        '''Removes all timestamps that are greater than the longest rate since
-        they no longer need to be tracked.'''
-        timestamps = APIRateMeter._tracked_keys[self.key]['requestTimestamps']
-        maxdelta = APIRateMeter._tracked_keys[self.key]['maxdelta']
-        timestamps = [ts for ts in timestamps if (ts - datetime.now()) < maxdelta]
-        APIRateMeter._tracked_keys[self.key]['requestTimestamps'] = timestamps
-
-    @staticmethod        
+        enough time has passed that the API should no longer be blocked. The
+        wait time is computed from the bucket refill rates rather than polled
+        for, so a blocked call sleeps once instead of spinning. The whole
+        check-then-take sequence runs under the key's lock, so blocked
+        threads take tokens one at a time instead of racing past the limit.'''
+        with self._state['lock']:
+            if blocking:
+                #Back off exponentially if the computed wait keeps coming up
+                #short (scheduler jitter, other consumers of the same key)
+                delay = 0.001
+                while True:
+                    #Sleep out any wait already known from a prior check
+                    #before recomputing the buckets
+                    diff = self._state['next_ok'] - time.monotonic_ns()
+                    if diff > 0:
+                        time.sleep(diff*1e-9)
+                    elif self._check():
+                        break
+                    else:
+                        time.sleep(max(self._wait,delay))
+                        delay = min(delay*3,0.1)
+            for bucket in self._state['buckets']:
+                bucket[2] -= 1
+
+    @staticmethod
+    def _makebuckets(rates):
+        now = time.monotonic_ns()
+        return [[rate[0],rate[0]/(rate[1].total_seconds()*1e9),rate[0],now]
+                for rate in rates]
+
+    @staticmethod
     def _validaterates(rates):
         if rates:
             try:
@@ -98,98 +150,165 @@ class RiotAPISession(Session):
             'ru':'ru.api.pvp.net',
             'tr':'tr.api.pvp.net'}
 
+    #Most entries the response cache will hold before evicting the least
+    #recently used one
+    CACHE_MAX_ENTRIES = 512
+
+    #Most ids Riot accepts in a single multi-id call
+    MAX_IDS_PER_CALL = 40
+
     def __init__(self,apikey,region):
         self.apikey = apikey
-        if region in RiotAPISession.REGIONS.keys():
+        if region in RiotAPISession.REGIONS:
             self.region = region
         else:
             raise InvalidServerRegion
 
+        #The region never changes for the life of the session, so build the
+        #URL prefix once instead of on every request
+        self._base_url = 'https://' + RiotAPISession.REGIONS[region]
+        #Likewise bake the region into every endpoint template up front;
+        #methods only substitute the per-call ids
+        prefix = '/api/lol/' + region
+        staticprefix = '/api/lol/static-data/' + region
+        self._endpoints = {
+            'champion':prefix + '/v1.2/champion',
+            'champion_by_id':prefix + '/v1.2/champion/{championid}',
+            'game_recent':prefix + '/v1.3/game/by-summoner/{summonerId}/recent',
+            'league_by_summoner':prefix + '/v2.4/league/by-summoner/{ids}',
+            'league_by_summoner_entry':prefix + '/v2.4/league/by-summoner/{ids}/entry',
+            'league_by_team':prefix + '/v2.4/league/by-team/{ids}',
+            'league_by_team_entry':prefix + '/v2.4/league/by-team/{ids}/entry',
+            'challenger':prefix + '/v2.4/league/challenger',
+            'match':prefix + '/v2.2/match/{matchId}',
+            'matchhistory':prefix + '/v2.2/matchhistory/{summonerId}',
+            'staticdata':staticprefix + '/v1.2/{static}',
+            'staticdata_by_id':staticprefix + '/v1.2/{static}/{objid}'}
+        self._cache = OrderedDict()
         self.ratemeter = APIRateMeter(self.apikey)
 
         super().__init__()
+        #Session-level params are merged into every request, so the API key
+        #is sent without mutating each caller's params dict
+        self.params = {'api_key':apikey}
+        #Every request goes to the one regional host, so keep its connections
+        #alive in a larger pool and retry transient connection failures
+        self.mount(self._base_url,HTTPAdapter(pool_connections=1,
+                pool_maxsize=20,max_retries=3))
 
-    def get(self,endpoint,params={},ratelimited=True):
+    def get(self,endpoint,params=None,ratelimited=True,ttl=None):
         '''Takes care of all the busy work that needs to be done every time the
         LoL API is called such triggering the rate limiter, passing the API key
-        as a parameter, and picking the correct region server.'''
-        params['api_key'] = self.apikey
+        as a parameter, and picking the correct region server. The API key is
+        supplied through the session-level params set in __init__, so it is
+        never written into the caller's params dict.
+
+        If ttl is given, successful responses are cached for that many seconds
+        and a cache hit is returned without spending a rate limit token or
+        touching the network. The cache holds at most CACHE_MAX_ENTRIES
+        responses and evicts the least recently used.'''
+        if ttl:
+            cachekey = (endpoint,tuple(sorted(params.items())) if params else ())
+            cached = self._cache.get(cachekey)
+            if cached and cached[0] > time.monotonic_ns():
+                self._cache.move_to_end(cachekey)
+                return cached[1]
         if ratelimited:
             self.ratemeter.access()
-        req = super().get('https://' + RiotAPISession.REGIONS[self.region] +
-                endpoint,params=params)
+        req = super().get(self._base_url + endpoint,params=params)
+        if ttl and req.status_code == 200:
+            self._cache[cachekey] = (time.monotonic_ns() + ttl*1_000_000_000,req)
+            self._cache.move_to_end(cachekey)
+            if len(self._cache) > RiotAPISession.CACHE_MAX_ENTRIES:
+                self._cache.popitem(last=False)
         return req
 
+    def _get_json(self,endpoint,params=None,ratelimited=True,ttl=None):
+        '''Fetches an endpoint through get and decodes the JSON body, with
+        orjson when it is installed.'''
+        req = self.get(endpoint,params=params,ratelimited=ratelimited,ttl=ttl)
+        if orjson is not None:
+            return orjson.loads(req.content)
+        return req.json()
+
     def champion(self,championid=None,freeToPlay=False):
         '''Returns information about champions. Can be given a champion id to
         get information on a specific champion, or if given no championId, will
         return a list of all champions. If freeToPlay is True, will only return
         champions that are currently free to play.'''
         if championid:
-            query = '/api/lol/{region}/v1.2/champion/{championid}'
-            query = query.format(championid=championid,region=self.region)
+            query = self._endpoints['champion_by_id'].format(championid=championid)
         else:
-            query = '/api/lol/{region}/v1.2/champion'
-            query = query.format(region=self.region)
+            query = self._endpoints['champion']
         p = {}
         if freeToPlay:
             p['freeToPlay'] = 'True'
 
-        return self.get(query,params=p).json()
+        return self._get_json(query,params=p,ttl=60)
 
     def game(self,summonerid):
         '''Returns a list of up to 10 most recent games by summonerId.'''
-        query = '/api/lol/{region}/v1.3/game/by-summoner/{summonerId}/recent'
-        query = query.format(region=self.region,summonerId=summonerid)
-        return self.get(query).json()
+        query = self._endpoints['game_recent'].format(summonerId=summonerid)
+        return self._get_json(query)
 
     def league_by_summoner(self,summonerids,summoneronly=False):
-        '''Gets ranked league information by summoner ID. summonerids should be
-        a list of up to 40 summonerids. If summoneronly is True, will only
-        return league information on the specific summoner. Otherwise, it will
-        return information for that summoner's entire league.'''
+        '''Gets ranked league information by summoner ID. summonerids may be a
+        single summonerid or a list of any length; lists are batched into one
+        API call per 40 ids and the results merged. If summoneronly is True,
+        will only return league information on the specific summoners.
+        Otherwise, it will return information for each summoner's entire
+        league.'''
         if summoneronly:
-            query = '/api/lol/{region}/v2.4/league/by-summoner/{summonerIds}/entry'
+            query = self._endpoints['league_by_summoner_entry']
         else:
-            query = '/api/lol/{region}/v2.4/league/by-summoner/{summonerIds}'
-        query = query.format(summonerIds=summonerids,region=self.region)
-        return self.get(query).json()
+            query = self._endpoints['league_by_summoner']
+        return self._getbatched(query,summonerids)
 
     def league_by_team(self,teamids,teamonly=False):
-        '''Gets ranked league information by team ID. teamids should be
-        a list of up to 40 teamids. If teamonly is True, will only
-        return league information on the specific team. Otherwise, it will
-        return information for that team's entire league.'''
+        '''Gets ranked league information by team ID. teamids may be a single
+        teamid or a list of any length; lists are batched into one API call
+        per 40 ids and the results merged. If teamonly is True, will only
+        return league information on the specific teams. Otherwise, it will
+        return information for each team's entire league.'''
         if teamonly:
-            query = '/api/lol/{region}/v2.4/league/by-team/{teamIds}/entry'
+            query = self._endpoints['league_by_team_entry']
         else:
-            query = '/api/lol/{region}/v2.4/league/by-team/{teamIds}'
-        query = query.format(teamIds=teamids,region=self.region)
-        return self.get(query).json()
+            query = self._endpoints['league_by_team']
+        return self._getbatched(query,teamids)
+
+    def _getbatched(self,query,objectids):
+        '''Issues a multi-id query in chunks of MAX_IDS_PER_CALL ids, one API
+        call per chunk, and merges the returned mappings. Looping callers that
+        pass a list spend one rate limit token per 40 ids instead of one per
+        id.'''
+        if not isinstance(objectids,(list,tuple)):
+            objectids = (objectids,)
+        merged = {}
+        for start in range(0,len(objectids),RiotAPISession.MAX_IDS_PER_CALL):
+            chunk = objectids[start:start + RiotAPISession.MAX_IDS_PER_CALL]
+            q = query.format(ids=','.join(str(objid) for objid in chunk))
+            merged.update(self._get_json(q))
+        return merged
 
     def challenger_league(self):
         '''Returns all information on the challenger league.'''
-        query = '/api/lol/{region}/v2.4/league/challenger'
-        query = query.format(region=self.region)
-        return self.get(query).json()
+        return self._get_json(self._endpoints['challenger'])
 
     def match(self,matchid,includeTimeline=True):
         '''Gets match data by matchid. If includeTimeline is True, will also
         retrieve timeline data for the match.'''
-        query = '/api/lol/{region}/v2.2/match/{matchId}'
-        query.format(region=self.region,matchId=matchid)
+        query = self._endpoints['match'].format(matchId=matchid)
         params = {}
         if includeTimeline:
             params['includeTimeline'] = 'True'
-        return self.get(query,params=params).json()
+        return self._get_json(query,params=params)
 
     def matchhistory(self,summonerid):
         '''Gets the match history for a summoner.'''
-        query = '/api/lol/{region}/v2.2/matchhistory/{summonerId}'
-        query.format(region=self.region,matchId=matchid)
-        return self.get(query).json()
+        query = self._endpoints['matchhistory'].format(summonerId=summonerid)
+        return self._get_json(query)
 
-    def getstaticdata(self,static,objectid=None,params={}):
+    def getstaticdata(self,static,objectid=None,params=None):
         '''Gets static data from LoL. Does not count against the API call
         limits. If static is not valid, will return False. params will be passed
         to the API, but are not currently validated. See Riot's documentation on
@@ -202,12 +321,11 @@ class RiotAPISession(Session):
                 'champion','item','mastery','realm','rune','summoner-spell','versions'):
             return False
         if objectid:
-            query = '/api/lol/static-data/{region}/v1.2/{static}/{objid}'
-            query = query.format(region=self.region,static=static,objid=objectid)
+            query = self._endpoints['staticdata_by_id'].format(static=static,
+                    objid=objectid)
         else:
-            query = '/api/lol/static-data/{region}/v1.2/{static}'
-            query = query.format(region=self.region,static=static)
-        return self.get(query,params=params,ratelimited=False)
+            query = self._endpoints['staticdata'].format(static=static)
+        return self.get(query,params=params,ratelimited=False,ttl=3600)
 
 #stats-v1.3 [BR, EUNE, EUW, KR, LAN, LAS, NA, OCE, RU, TR] Show/Hide List OperationsExpand Operations
 '/api/lol/{region}/v1.3/stats/by-summoner/{summonerId}/ranked' #Get ranked stats by summoner ID. (REST)